@@ -1,16 +1,116 @@
 from fastapi import FastAPI, UploadFile, File, Form, status, Request, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
+from fastapi.responses import JSONResponse, Response, FileResponse
+from starlette.datastructures import Headers, MutableHeaders
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+import asyncio
+import functools
+import hashlib
+import io
 import shutil
 import os
-import logging,subprocess
+import logging
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
 
-from utils.marine import predict_on_images, predict_on_video
+import aiofiles
+
+from utils.marine import predict_on_images, predict_on_video, warm_up_models
 from .config import MODELS_DIR, UPLOAD_DIR, RESULT_DIR
 
 app = FastAPI()
 
+# Range headers asking for more ranges than this are ignored (whole file is sent)
+_MAX_RANGES = 16
+# Buffer size for persisting uploads when sendfile cannot be used.
+_UPLOAD_COPY_BUFFER = 1024 * 1024
+# Uploads up to this size are read into memory and written in a single call
+_SMALL_UPLOAD_SIZE = 8 * 1024 * 1024
+# Uploads of one request persisted concurrently
+_UPLOAD_CONCURRENCY = 4
+# Media types mimetypes does not know (or gets wrong: .ts is not a Qt translation here)
+_RESULT_MEDIA_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".ts": "video/mp2t",
+}
+# Single worker so inference jobs never run concurrently on the GPU
+_infer_pool = ThreadPoolExecutor(max_workers=1)
+
+
+class ResultFileResponse(FileResponse):
+    """
+    FileResponse for result files.
+
+    Range handling (If-Range, merging of overlapping ranges, multipart bodies)
+    is left to FileResponse, except that:
+
+    - a header asking for more than ``_MAX_RANGES`` ranges is ignored and the
+      whole file is sent, instead of an amplified multipart body;
+    - a single satisfiable range is handed to the ASGI server as a file
+      descriptor when it advertises the ``http.response.zerocopysend``
+      extension, so it can be sent with sendfile(2).
+    """
+
+    async def __call__(self, scope, receive, send):
+        request_headers = Headers(scope=scope)
+        range_header = request_headers.get("range")
+
+        if range_header is not None:
+            range_specs = [spec for spec in range_header.partition("=")[2].split(",") if spec.strip()]
+            if len(range_specs) > _MAX_RANGES:
+                scope = {
+                    **scope,
+                    "headers": [(k, v) for k, v in scope["headers"] if k.lower() != b"range"],
+                }
+            elif "http.response.zerocopysend" in scope.get("extensions", {}):
+                if_range = request_headers.get("if-range")
+                if if_range is None or if_range == self.headers["etag"]:
+                    stat_result = os.stat(self.path)
+                    try:
+                        ranges = _parse_range_header(range_header, stat_result.st_size)
+                    except ValueError:
+                        ranges = []
+                    if len(ranges) == 1:
+                        await self._zero_copy_send(send, stat_result, *ranges[0])
+                        return
+
+        async def send_with_multipart_type(message):
+            # Starlette announces multipart/byteranges in Content-Range rather than
+            # Content-Type; move it so clients can parse the multipart body.
+            if message["type"] == "http.response.start" and message["status"] == 206:
+                headers = MutableHeaders(raw=list(message["headers"]))
+                content_range = headers.get("content-range", "")
+                if content_range.startswith("multipart/byteranges"):
+                    headers["content-type"] = content_range
+                    del headers["content-range"]
+                    message = {**message, "headers": headers.raw}
+            await send(message)
+
+        await super().__call__(scope, receive, send_with_multipart_type)
+
+    async def _zero_copy_send(self, send, stat_result, range_start: int, range_end: int) -> None:
+        self.set_stat_headers(stat_result)
+        count = range_end - range_start + 1
+        self.headers["content-length"] = str(count)
+        self.headers["content-range"] = f"bytes {range_start}-{range_end}/{stat_result.st_size}"
+
+        await send({
+            "type": "http.response.start",
+            "status": 206,
+            "headers": self.raw_headers,
+        })
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.lseek(fd, range_start, os.SEEK_SET)
+            await send({
+                "type": "http.response.zerocopysend",
+                "file": fd,
+                "offset": range_start,
+                "count": count,
+                "more_body": False,
+            })
+        finally:
+            os.close(fd)
+
 # Middleware
 app.add_middleware(
     CORSMiddleware,
@@ -18,20 +118,102 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["Content-Range", "Accept-Ranges","Content-Length", "Content-Type"]
+    expose_headers=["Content-Range", "Accept-Ranges","Content-Length", "Content-Type", "ETag"]
 )
 
-# Serve static video results
-app.mount("/results", StaticFiles(directory="results"), name="results")
-
 # Ensure directories exist
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(RESULT_DIR, exist_ok=True)
 os.makedirs(MODELS_DIR, exist_ok=True)
 
 
+# (MODELS_DIR mtime, model paths) from the last directory scan
+_model_paths_cache = (None, [])
+
+
+def _model_paths() -> list[str]:
+    """Returns the .pt model files in MODELS_DIR, rescanning only when the directory changes."""
+    global _model_paths_cache
+    mtime = os.stat(MODELS_DIR).st_mtime
+    if _model_paths_cache[0] != mtime:
+        paths = sorted(
+            entry.path for entry in os.scandir(MODELS_DIR)
+            if entry.is_file() and entry.name.endswith('.pt')
+        )
+        _model_paths_cache = (mtime, paths)
+    return _model_paths_cache[1]
+
+
+@app.on_event("startup")
+def load_models():
+    # Warm the model cache and CUDA so the first request does not pay the load cost
+    warm_up_models(_model_paths())
+
+
+def _fast_upload_copy(src, dst) -> None:
+    """
+    Copies an uploaded file to ``dst``.
+
+    Uploads that were spooled to disk are copied in the kernel with sendfile;
+    in-memory uploads (or platforms without file-to-file sendfile) fall back
+    to a buffered copy.
+    """
+    # SpooledTemporaryFile only has a real descriptor once rolled to disk;
+    # calling fileno() before that would force the rollover.
+    if getattr(src, "_rolled", True):
+        try:
+            src_fd = src.fileno()
+            size = os.fstat(src_fd).st_size
+            dst.flush()
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(dst.fileno(), src_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            return
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+
+    shutil.copyfileobj(src, dst, length=_UPLOAD_COPY_BUFFER)
+
+
+def _save_upload(upload: UploadFile, path: str) -> None:
+    with open(path, "wb") as buffer:
+        _fast_upload_copy(upload.file, buffer)
+
+
+async def _persist_upload(upload: UploadFile, path: str) -> None:
+    """Writes an upload to ``path``: small files in one write, large ones with a bounded-memory copy."""
+    if upload.size is not None and upload.size <= _SMALL_UPLOAD_SIZE:
+        contents = await upload.read()
+        async with aiofiles.open(path, "wb") as f:
+            await f.write(contents)
+    else:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, _save_upload, upload, path)
+
+
+async def _run_inference(func, **kwargs) -> None:
+    """Runs a blocking prediction function on the inference worker."""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_infer_pool, functools.partial(func, **kwargs))
+
+
+def _predict_video_to_hls(output_hls_dir: str, **kwargs) -> None:
+    """Encodes into an emptied HLS directory; runs on the inference worker."""
+    # Clearing only once the worker is ours keeps an earlier request with the same
+    # filename from losing its segments while ffmpeg is still writing them, and
+    # guarantees a stale playlist is never returned
+    shutil.rmtree(output_hls_dir, ignore_errors=True)
+    os.makedirs(output_hls_dir, exist_ok=True)
+    predict_on_video(**kwargs)
+
+
 @app.post("/predict/images")
-def predict_images(
+async def predict_images(
     confs_threshold: list[float] = Form(...),
     images: list[UploadFile] = File(...)
 ):
@@ -40,13 +222,22 @@ def predict_images(
     os.makedirs(input_folder, exist_ok=True)
     os.makedirs(output_folder, exist_ok=True)
 
-    for image in images:
-        with open(os.path.join(input_folder, image.filename), "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
+    # Bounded so at most _UPLOAD_CONCURRENCY small uploads are held in memory at once
+    upload_slots = asyncio.Semaphore(_UPLOAD_CONCURRENCY)
 
-    model_paths = [os.path.join(MODELS_DIR, name) for name in os.listdir(MODELS_DIR) if name.endswith('.pt')]
+    async def persist(image: UploadFile) -> None:
+        async with upload_slots:
+            await _persist_upload(image, os.path.join(input_folder, image.filename))
 
-    predict_on_images(
+    # Uploads sharing a filename would write the same file concurrently; like the
+    # former sequential saves, the last one wins
+    unique_images = {image.filename: image for image in images}
+    await asyncio.gather(*(persist(image) for image in unique_images.values()))
+
+    model_paths = _model_paths()
+
+    await _run_inference(
+        predict_on_images,
         model_paths=model_paths,
         confs_threshold=confs_threshold,
         images_input_folder_path=input_folder,
@@ -56,55 +247,39 @@ def predict_images(
     return JSONResponse({"result_folder": output_folder})
 
 
-import subprocess
-
 @app.post("/predict/video")
-def predict_video(
+async def predict_video(
     video: UploadFile = File(...),
     max_frames: int = 100
 ):
     input_video_path = os.path.join(UPLOAD_DIR, video.filename)
-    output_video_path = os.path.join(RESULT_DIR, f"result_{video.filename}")
     output_hls_dir = os.path.join(RESULT_DIR, f"hls_{video.filename}")
-    os.makedirs(output_hls_dir, exist_ok=True)
+    hls_playlist_path = os.path.join(output_hls_dir, "index.m3u8")
     
     confs_threshold = [0.5, 0.5, 0.5]
 
     # Save uploaded video
-    with open(input_video_path, "wb") as buffer:
-        shutil.copyfileobj(video.file, buffer)
-
-    # Run prediction
-    model_paths = [os.path.join(MODELS_DIR, name) for name in os.listdir(MODELS_DIR) if name.endswith('.pt')]
-    predict_on_video(
-        model_paths=model_paths,
-        confs_threshold=confs_threshold,
-        input_video_path=input_video_path,
-        output_video_path=output_video_path,
-        max_frames=max_frames
-    )
-
-    # Convert to HLS using ffmpeg
-    hls_playlist_path = os.path.join(output_hls_dir, "index.m3u8")
-    ffmpeg_command = [
-        "ffmpeg",
-        "-i", output_video_path,
-        "-codec:V", "libx264",
-        "-codec:a", "aac",
-        "-flags", "+cgop",
-        "-g", "30",
-        "-hls_time", "4",
-        "-hls_list_size", "0",
-        "-f", "hls",
-        hls_playlist_path
-    ]
+    await _persist_upload(video, input_video_path)
 
+    # Run prediction, encoding the annotated frames straight to HLS
+    model_paths = _model_paths()
     try:
-        subprocess.run(ffmpeg_command, check=True)
-    except subprocess.CalledProcessError as e:
+        await _run_inference(
+            _predict_video_to_hls,
+            output_hls_dir=output_hls_dir,
+            model_paths=model_paths,
+            confs_threshold=confs_threshold,
+            input_video_path=input_video_path,
+            output_video_path=hls_playlist_path,
+            max_frames=max_frames
+        )
+    except RuntimeError as e:
         logging.error(f"HLS conversion failed: {e}")
         raise HTTPException(status_code=500, detail="Failed to convert video to HLS")
 
+    if not os.path.exists(hls_playlist_path):
+        raise HTTPException(status_code=500, detail="Failed to convert video to HLS")
+
     # Return path to HLS playlist (relative to /results)
     hls_relative_path = f"hls_{video.filename}/index.m3u8"
     return {"hls_url": f"/results/{hls_relative_path}"}
@@ -115,81 +290,109 @@ def root():
     return {"message": "Marine Detect API is running."}
 
 
-@app.get("/results/{filename}")
-async def get_result_video(filename: str, request: Request):
-    file_path = os.path.join(RESULT_DIR, filename)
-    
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="Video not found")
+def _resolve_result_file(file_path: str) -> str:
+    """Returns the absolute path of a file under RESULT_DIR, raising 404 if there is none."""
+    result_dir = os.path.realpath(RESULT_DIR)
+    full_path = os.path.realpath(os.path.join(result_dir, file_path))
+    if os.path.commonpath([result_dir, full_path]) != result_dir or not os.path.isfile(full_path):
+        raise HTTPException(status_code=404, detail="File not found")
+    return full_path
+
 
-    file_size = os.path.getsize(file_path)
-    range_header = request.headers.get("range")
+def _result_media_type(file_path: str) -> str:
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in _RESULT_MEDIA_TYPES:
+        return _RESULT_MEDIA_TYPES[extension]
+    return mimetypes.guess_type(file_path)[0] or "application/octet-stream"
 
-    headers = {
-        "Content-Type": "video/mp4",
+
+def _result_file_headers(file_path: str, media_type: str) -> dict:
+    """Headers shared by every response for a result file, including its ETag."""
+    stat = os.stat(file_path)
+    etag = hashlib.sha1(f"{stat.st_mtime}-{stat.st_size}".encode()).hexdigest()
+    return {
+        "Content-Type": media_type,
         "Accept-Ranges": "bytes",
-        "Content-Length": str(file_size),
         "Cache-Control": "no-cache",
+        "ETag": f'"{etag}"',
     }
 
-    if range_header:
-        try:
-            range_val = range_header.strip().split("=")[-1]
-            range_start, range_end = range_val.split("-")
-            range_start = int(range_start) if range_start else 0
+
+def _parse_range_header(range_header: str, file_size: int) -> list[tuple[int, int]]:
+    """
+    Parses a ``bytes=`` Range header (RFC 7233) into inclusive (start, end) pairs.
+
+    Empty elements are skipped. Raises ValueError for a malformed header or
+    when no range can be satisfied.
+    """
+    units, _, range_set = range_header.strip().partition("=")
+    if units.strip().lower() != "bytes":
+        raise ValueError(f"Unsupported range unit: {units}")
+
+    ranges = []
+    for range_spec in range_set.split(","):
+        range_spec = range_spec.strip()
+        if not range_spec:
+            continue
+        range_start, range_end = range_spec.split("-")
+        if not range_start:
+            # Suffix range: the last N bytes
+            suffix_length = int(range_end)
+            range_start, range_end = max(file_size - suffix_length, 0), file_size - 1
+        else:
+            range_start = int(range_start)
             range_end = int(range_end) if range_end else file_size - 1
-            range_end = min(range_end, file_size - 1)
-            chunk_size = (range_end - range_start) + 1
-
-            async def range_stream():
-                try:
-                    with open(file_path, "rb") as f:
-                        f.seek(range_start)
-                        remaining = chunk_size
-                        while remaining > 0:
-                            chunk = f.read(min(4096, remaining))
-                            if not chunk:
-                                break
-                            remaining -= len(chunk)
-                            yield chunk
-                except (ConnectionResetError, BrokenPipeError):
-                    logging.info("Client disconnected during streaming")
-                except Exception as e:
-                    logging.error(f"Streaming error: {str(e)}")
-
-            headers["Content-Range"] = f"bytes {range_start}-{range_end}/{file_size}"
-            return StreamingResponse(
-                range_stream(),
-                status_code=206,
-                headers=headers,
-                media_type="video/mp4"
-            )
-        except Exception as e:
-            logging.error(f"Range header processing error: {str(e)}")
-            raise HTTPException(status_code=400, detail="Invalid range header")
-
-    # return FileResponse(
-    #     file_path,
-    #     headers=headers,
-    #     media_type="video/mp4"
-    # )
-    # Full video stream (no Range header)
-
-    def full_stream():
-        try:
-            with open(file_path, "rb") as f:
-                yield from f
-        except ConnectionResetError:
-            print("Client disconnected while streaming (full).")
-            return
+        range_end = min(range_end, file_size - 1)
+        if range_start > range_end:
+            continue
+        ranges.append((range_start, range_end))
+
+    if not ranges:
+        raise ValueError("Requested range not satisfiable")
+    return ranges
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether an If-None-Match header matches ``etag`` (weak comparison, RFC 7232)."""
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+def _not_modified_response(headers: dict) -> Response:
+    headers = {key: value for key, value in headers.items() if key != "Content-Type"}
+    return Response(status_code=304, headers=headers)
+
+
+# HLS output and annotated images are served from RESULT_DIR by these routes
+# (rather than a StaticFiles mount) so byte ranges, ETags and zero-copy sends apply.
+@app.head("/results/{file_path:path}")
+async def head_result_file(file_path: str, request: Request):
+    full_path = _resolve_result_file(file_path)
+    media_type = _result_media_type(full_path)
+
+    headers = _result_file_headers(full_path, media_type)
+    if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return _not_modified_response(headers)
+
+    headers["Content-Length"] = str(os.path.getsize(full_path))
+    return Response(headers=headers, media_type=media_type)
+
+
+@app.get("/results/{file_path:path}")
+async def get_result_file(file_path: str, request: Request):
+    full_path = _resolve_result_file(file_path)
+    media_type = _result_media_type(full_path)
+
+    headers = _result_file_headers(full_path, media_type)
+    if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return _not_modified_response(headers)
 
-    return StreamingResponse(
-        full_stream(),
-        media_type="video/mp4",
-        headers={
-            "Content-Length": str(file_size),
-            "Accept-Ranges": "bytes",
-            "content-encoding": "identity",
-            "Content-Type": "video/mp4"
-        }
+    # FileResponse serves the whole file or the requested ranges (honoring If-Range)
+    # through the server's optimized file path; see ResultFileResponse.
+    return ResultFileResponse(
+        full_path,
+        headers=headers,
+        media_type=media_type
     )
@@ -13,13 +13,175 @@ Authors: Eléonore Charles
 Software description: Object detection models for identifying species in marine environments.
 """
 
+import itertools
 import os
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO
 
 import cv2
 import numpy as np
-from PIL import ExifTags, Image
+import torch
 from tqdm import tqdm
 from ultralytics import YOLO
+from ultralytics.utils.plotting import colors
+
+try:
+    import decord  # Optional: NVDEC video decoding
+except ImportError:
+    decord = None
+
+try:
+    import onnxruntime  # Optional: runs ONNX exports
+except ImportError:
+    onnxruntime = None
+
+# Box colors, same palette as Ultralytics' plot()
+_BOX_COLORS = [colors(i, True) for i in range(len(colors.palette))]
+
+# Progress bars are only drawn when MARINE_PROGRESS is set (e.g. CLI runs)
+_SHOW_PROGRESS = bool(os.environ.get("MARINE_PROGRESS"))
+
+# Run inference in FP16 on GPU; CPU inference stays FP32
+_USE_HALF = torch.cuda.is_available()
+
+# Loaded models, keyed by (model path, file modification time)
+_MODEL_CACHE: dict[tuple[str, float], YOLO] = {}
+
+
+def _export_formats() -> list[str]:
+    """Export formats worth building on this machine, in order of preference."""
+    onnx_providers = onnxruntime.get_available_providers() if onnxruntime is not None else []
+    if torch.cuda.is_available():
+        # A CPU-only ONNX Runtime would be slower than PyTorch on the GPU
+        return ["engine"] + (["onnx"] if "CUDAExecutionProvider" in onnx_providers else [])
+    return ["onnx"] if onnx_providers else []
+
+
+def export_model(model_path: str, batch_size: int = 16, build: bool = True) -> str:
+    """
+    Returns the path of an optimized export of a PyTorch YOLO model, building it once.
+
+    On GPU the model is exported to a TensorRT engine, or to ONNX when ONNX
+    Runtime has the CUDA provider; on CPU it is exported to ONNX. The export is
+    stored next to the '.pt' file and rebuilt when the '.pt' file is newer. A
+    failed export is recorded in a '.failed' marker file and not retried until
+    the '.pt' file changes. If no export is usable, the original path is returned.
+
+    Args:
+        model_path (str): Path to the YOLO '.pt' model file.
+        batch_size (int): Largest batch the exported model must accept.
+        build (bool): Whether to build missing exports, or only use existing ones.
+
+    Returns:
+        str: Path of the model file to load.
+    """
+    if not model_path.endswith(".pt"):
+        return model_path
+
+    model_mtime = os.path.getmtime(model_path)
+    for export_format in _export_formats():
+        exported_path = f"{os.path.splitext(model_path)[0]}.{export_format}"
+        if os.path.exists(exported_path) and os.path.getmtime(exported_path) >= model_mtime:
+            return exported_path
+
+        failed_marker = f"{exported_path}.failed"
+        if not build or (os.path.exists(failed_marker) and os.path.getmtime(failed_marker) >= model_mtime):
+            continue
+
+        try:
+            return YOLO(model_path).export(
+                format=export_format,
+                imgsz=640,
+                half=_USE_HALF,
+                dynamic=True,
+                batch=batch_size,
+                device=0 if _USE_HALF else "cpu",
+            )
+        except Exception as e:
+            print(f"⚠️ Warning: Could not export {model_path} to {export_format}: {e}")
+            with open(failed_marker, "w") as f:
+                f.write(str(e))
+
+    return model_path
+
+
+def load_model(model_path: str, build_export: bool = True) -> YOLO:
+    """
+    Loads a YOLO model from its optimized export, falling back to the original file.
+
+    A single dummy prediction is run on whichever model is loaded. Exported
+    backends are only initialized on first inference, so this detects unusable
+    exports (e.g. a TensorRT engine built for another GPU or TensorRT version),
+    and it moves CUDA context creation and cuDNN kernel selection out of the
+    first request.
+
+    Args:
+        model_path (str): Path to the YOLO model file.
+        build_export (bool): Whether a missing export may be built (see `export_model`).
+
+    Returns:
+        YOLO: Loaded model.
+    """
+    dummy_frame = np.zeros((640, 640, 3), dtype=np.uint8)
+
+    runtime_path = export_model(model_path, build=build_export)
+    if runtime_path != model_path:
+        try:
+            model = YOLO(runtime_path, task="detect")
+            model.predict(dummy_frame, half=_USE_HALF, verbose=False)
+            return model
+        except Exception as e:
+            print(f"⚠️ Warning: Could not load {runtime_path}, using {model_path}: {e}")
+
+    model = YOLO(model_path)
+    model.predict(dummy_frame, half=_USE_HALF, verbose=False)
+    return model
+
+
+def get_model(model_path: str, build_export: bool = False) -> YOLO:
+    """
+    Returns the YOLO model stored at the given path, loading it only once.
+
+    The model is loaded from its optimized export when usable (see `load_model`)
+    and reloaded if its file has been modified since it was cached. Exports are
+    only built when requested (at startup), so a request never waits for one.
+
+    Args:
+        model_path (str): Path to the YOLO model file.
+        build_export (bool): Whether a missing export may be built.
+
+    Returns:
+        YOLO: Loaded model.
+    """
+    key = (model_path, os.path.getmtime(model_path))
+    model = _MODEL_CACHE.get(key)
+    if model is None:
+        for stale_key in [k for k in _MODEL_CACHE if k[0] == model_path]:
+            del _MODEL_CACHE[stale_key]
+        model = _MODEL_CACHE[key] = load_model(model_path, build_export)
+    return model
+
+
+def warm_up_models(model_paths: list[str]) -> None:
+    """
+    Loads the models, building missing exports, so the first request does not pay
+    for exporting or for the warm-up inference run by `load_model`.
+
+    Args:
+        model_paths (list[str]): Paths to YOLO model files.
+
+    Returns:
+        None
+    """
+    if torch.cuda.is_available():
+        torch.backends.cudnn.benchmark = True
+        # Inference runs on the GPU; extra CPU threads only contend between requests
+        torch.set_num_threads(1)
+
+    for model_path in model_paths:
+        get_model(model_path, build_export=True)
 
 
 def save_combined_image(
@@ -27,6 +189,7 @@ def save_combined_image(
     image_name: str,
     output_folder_pred_images: str,
     combined_results: list,
+    image: np.ndarray = None,
 ) -> None:
     """
     Saves the results of multiple detections on an image using specified parameters.
@@ -35,59 +198,248 @@ def save_combined_image(
         images_input_folder_path (str): Path to the folder containing input images.
         image_name (str): Name of the input image.
         output_folder_pred_images (str): Path to the folder where the combined images will be saved.
-        combined_results (list): List of detection results.
+        combined_results (list): List of detection results, one list of results per model.
+        image (np.ndarray, optional): Already decoded BGR image. Read from the input folder if None.
 
     Returns:
         None
     """
-    # Open the image and check its orientation
-    img_path = os.path.join(images_input_folder_path, image_name)
-    original_image = Image.open(img_path)
-
-    try:
-        for orientation in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation] == "Orientation":
-                break
-        exif = dict(original_image._getexif().items())
-
-        if exif[orientation] == 3:
-            original_image = original_image.rotate(180, expand=True)
-        elif exif[orientation] == 6:
-            original_image = original_image.rotate(270, expand=True)
-        elif exif[orientation] == 8:
-            original_image = original_image.rotate(90, expand=True)
-    except (AttributeError, KeyError, IndexError):
-        # cases: image don't have getexif
-        pass
+    # cv2.imread decodes straight to BGR and applies the EXIF orientation
+    if image is None:
+        img_path = os.path.join(images_input_folder_path, image_name)
+        image = cv2.imread(img_path, cv2.IMREAD_COLOR)
 
     output_path = os.path.join(output_folder_pred_images, image_name)
-    combined_image = combine_results(np.array(original_image), combined_results)
-    combined_image = cv2.cvtColor(combined_image, cv2.COLOR_BGR2RGB)
-    combined_image = combined_image[..., ::-1]
-    combined_image = Image.fromarray(combined_image)
-    combined_image.save(output_path)
+    combined_image = combine_results(image, combined_results)
+    cv2.imwrite(output_path, combined_image)
 
 
 def combine_results(original_image: np.ndarray, results_list: list) -> np.ndarray:
     """
     Combines results from a list of detection outcomes.
 
-    It uses the original image and returns the resulting combined image array.
+    The boxes of every result are gathered and drawn in a single pass directly
+    on the original image, which is returned.
 
     Args:
         original_image (np.ndarray): Array representing the original image.
-        results_list (list): List of detection results.
+        results_list (list): List of detection results, one list of results per model.
 
     Returns:
         np.ndarray: Combined image array.
     """
-    combined_image = original_image
-
+    all_boxes, all_cls, all_labels = [], [], []
     for results in results_list:
         for result in results:
-            combined_image = result.plot(img=combined_image)
+            boxes = result.boxes
+            if boxes is None or len(boxes) == 0:
+                continue
+            cls = boxes.cls.cpu().numpy().astype(int)
+            conf = boxes.conf.cpu().numpy()
+            all_boxes.append(boxes.xyxy.cpu().numpy())
+            all_cls.append(cls)
+            all_labels.extend(f"{result.names[c]} {p:.2f}" for c, p in zip(cls, conf))
+
+    if not all_boxes:
+        return original_image
+
+    xyxy = np.concatenate(all_boxes).round().astype(int).tolist()
+    cls = np.concatenate(all_cls).tolist()
+
+    # Same line width and font sizing as Ultralytics' plot()
+    line_width = max(round(sum(original_image.shape) / 2 * 0.003), 2)
+    font_scale = line_width / 3
+    font_thickness = max(line_width - 1, 1)
+
+    for (x1, y1, x2, y2), c, label in zip(xyxy, cls, all_labels):
+        color = _BOX_COLORS[c % len(_BOX_COLORS)]
+        cv2.rectangle(original_image, (x1, y1), (x2, y2), color, line_width, cv2.LINE_AA)
+
+        (text_w, text_h), _ = cv2.getTextSize(label, 0, font_scale, font_thickness)
+        outside = y1 - text_h >= 3
+        label_y2 = y1 - text_h - 3 if outside else y1 + text_h + 3
+        cv2.rectangle(original_image, (x1, y1), (x1 + text_w, label_y2), color, -1, cv2.LINE_AA)
+        cv2.putText(
+            original_image,
+            label,
+            (x1, y1 - 2 if outside else y1 + text_h + 2),
+            0,
+            font_scale,
+            (255, 255, 255),
+            font_thickness,
+            cv2.LINE_AA,
+        )
+
+    return original_image
+
+
+def write_annotated_batch(
+    models: list[YOLO],
+    confs_threshold: list[float],
+    frames: list[np.ndarray],
+    out: BinaryIO,
+    infer_flags: list[bool] = None,
+    last_results: list = None,
+) -> list:
+    """
+    Runs each model once on a batch of frames and writes the annotated frames.
+
+    Only the frames flagged for inference are passed to the models; the other
+    frames are annotated with the results of the closest preceding inferred frame.
 
-    return combined_image
+    Args:
+        models (list[YOLO]): Loaded YOLO models.
+        confs_threshold (list[float]): Confidence thresholds for each model.
+        frames (list[np.ndarray]): Batch of BGR frames, in video order.
+        out (BinaryIO): Stream receiving the annotated frames as raw BGR bytes.
+        infer_flags (list[bool], optional): Whether each frame is inferred. Default is all frames.
+        last_results (list, optional): Results of the last inferred frame of the previous batch.
+
+    Returns:
+        list: Results of the last inferred frame, to pass to the next batch.
+    """
+    if infer_flags is None:
+        infer_flags = [True] * len(frames)
+
+    infer_frames = [frame for frame, flag in zip(frames, infer_flags) if flag]
+    try:
+        batch_results = [
+            model(infer_frames, conf=confs_threshold[i], half=_USE_HALF) if infer_frames else []
+            for i, model in enumerate(models)
+        ]
+    except Exception as e:
+        print(f"⚠️ Error during model prediction: {e}")
+        return last_results
+
+    current_results = last_results or []
+    inferred = 0
+    for frame, flag in zip(frames, infer_flags):
+        if flag:
+            current_results = [[results[inferred]] for results in batch_results]
+            inferred += 1
+        try:
+            annotated_frame = combine_results(frame, current_results)
+            out.write(np.ascontiguousarray(annotated_frame).data)
+        except BrokenPipeError:
+            # The encoder is gone; every following write would fail too
+            raise
+        except Exception as e:
+            print(f"⚠️ Error during frame annotation: {e}")
+
+    return current_results
+
+
+def read_video_frames(cap: cv2.VideoCapture, input_video_path: str, batch_size: int):
+    """
+    Yields the BGR frames of a video.
+
+    Frames are decoded on the GPU (NVDEC) through decord when it is installed
+    and CUDA is available, otherwise they are read with OpenCV.
+
+    Args:
+        cap (cv2.VideoCapture): Opened capture of the video, used as fallback.
+        input_video_path (str): Path to input video.
+        batch_size (int): Number of frames decoded per GPU call.
+
+    Yields:
+        np.ndarray: BGR frame.
+    """
+    if decord is not None and torch.cuda.is_available():
+        try:
+            reader = decord.VideoReader(input_video_path, ctx=decord.gpu(0))
+        except Exception as e:
+            print(f"⚠️ GPU decoding unavailable, falling back to OpenCV: {e}")
+        else:
+            for start in range(0, len(reader), batch_size):
+                batch = reader.get_batch(range(start, min(start + batch_size, len(reader))))
+                # decord decodes to RGB; models and writer expect BGR
+                for frame in batch.asnumpy()[..., ::-1]:
+                    yield np.ascontiguousarray(frame)
+            print("✅ End of video.")
+            return
+
+    while cap.isOpened():
+        success, frame = cap.read()
+        if not success:
+            print("✅ End of video or failed to read frame.")
+            break
+        yield frame
+
+
+def prefetch_images(images_input_folder_path: str, image_names: list[str], depth: int):
+    """
+    Yields decoded images, reading up to `depth` images ahead on worker threads.
+
+    Args:
+        images_input_folder_path (str): Path to the folder containing input images.
+        image_names (list[str]): Names of the images to read, in order.
+        depth (int): Number of images decoded ahead of the consumer.
+
+    Yields:
+        tuple[str, np.ndarray]: Image name and BGR image (None if it could not be read).
+    """
+    with ThreadPoolExecutor(max_workers=4) as io_pool:
+        pending = deque()
+        for image_name in image_names:
+            img_path = os.path.join(images_input_folder_path, image_name)
+            pending.append((image_name, io_pool.submit(cv2.imread, img_path)))
+            if len(pending) > depth:
+                name, future = pending.popleft()
+                yield name, future.result()
+
+        while pending:
+            name, future = pending.popleft()
+            yield name, future.result()
+
+
+def predict_image_batch(
+    models: list[YOLO],
+    confs_threshold: list[float],
+    images_input_folder_path: str,
+    images_output_folder_path: str,
+    image_names: list[str],
+    images: list[np.ndarray],
+    save_txt: bool = False,
+    save_conf: bool = False,
+) -> None:
+    """
+    Runs each model once on a batch of decoded images and saves the results.
+
+    Args:
+        models (list[YOLO]): Loaded YOLO models.
+        confs_threshold (list[float]): Confidence thresholds for each model.
+        images_input_folder_path (str): Path to the folder containing input images.
+        images_output_folder_path (str): Path to the folder where annotated images will be saved.
+        image_names (list[str]): Names of the images in the batch.
+        images (list[np.ndarray]): Decoded BGR images, in the same order as `image_names`.
+        save_txt (bool): Whether to save bounding box coordinates in text files.
+        save_conf (bool): Whether to save confidence scores in text files.
+
+    Returns:
+        None
+    """
+    batch_results = [
+        model(images, conf=confs_threshold[i], half=_USE_HALF) for i, model in enumerate(models)
+    ]
+
+    for j, image_name in enumerate(image_names):
+        combined_results = [[results[j]] for results in batch_results]
+
+        if save_txt:
+            labels_folder = os.path.join(images_output_folder_path, "labels")
+            os.makedirs(labels_folder, exist_ok=True)
+            stem = os.path.splitext(image_name)[0]
+            for i, (result,) in enumerate(combined_results):
+                result.save_txt(os.path.join(labels_folder, f"{stem}_{i}.txt"), save_conf=save_conf)
+
+        if images_output_folder_path:
+            save_combined_image(
+                images_input_folder_path,
+                image_name,
+                images_output_folder_path,
+                combined_results,
+                images[j],
+            )
 
 
 def predict_on_images(
@@ -97,45 +449,73 @@ def predict_on_images(
     images_output_folder_path: str,
     save_txt: bool = False,
     save_conf: bool = False,
+    batch_size: int = 16,
 ) -> None:
     """
     Utilizes a list of YOLO models to predict detections on a set of images.
     Model files should be stored in the 'models' folder for best practice.
 
+    Images are decoded on background threads while the previous batch is
+    being processed.
+
     Args:
         model_paths (list[str]): List of paths to YOLO model files.
         confs_threshold (list[float]): List of confidence thresholds corresponding to each model.
         images_input_folder_path (str): Path to the folder containing input images.
         images_output_folder_path (str): Path to the folder where annotated images will be saved.
-        save_txt (bool): Whether to save bounding box coordinates in text files.
+        save_txt (bool): Whether to save bounding box coordinates in text files
+            (written to a 'labels' subfolder of the output folder, one file per model).
         save_conf (bool): Whether to save confidence scores in text files.
+        batch_size (int): Number of images passed to each model per call.
 
     Returns:
         None
     """
-    models = [YOLO(model_path) for model_path in model_paths]
+    models = [get_model(model_path) for model_path in model_paths]
 
     if images_output_folder_path:
         os.makedirs(f"{images_output_folder_path}", exist_ok=True)
 
-    for image_name in tqdm(os.listdir(images_input_folder_path)):
-        combined_results = []
-        for i, model in enumerate(models):
-            results = model(
-                os.path.join(images_input_folder_path, image_name),
-                conf=confs_threshold[i],
-                save_txt=save_txt,
-                save_conf=save_conf,
-            )
-            combined_results.extend(results)
+    image_names = os.listdir(images_input_folder_path)
+    batch_names, batch_images = [], []
 
-        if images_output_folder_path:
-            save_combined_image(
+    for image_name, image in tqdm(
+        prefetch_images(images_input_folder_path, image_names, depth=batch_size + 2),
+        total=len(image_names),
+        disable=not _SHOW_PROGRESS,
+    ):
+        if image is None:
+            print(f"⚠️ Warning: Cannot read image file: {image_name}")
+            continue
+
+        batch_names.append(image_name)
+        batch_images.append(image)
+
+        if len(batch_images) == batch_size:
+            predict_image_batch(
+                models,
+                confs_threshold,
                 images_input_folder_path,
-                image_name,
                 images_output_folder_path,
-                combined_results,
+                batch_names,
+                batch_images,
+                save_txt,
+                save_conf,
             )
+            batch_names, batch_images = [], []
+
+    # Flush the remaining partial batch
+    if batch_images:
+        predict_image_batch(
+            models,
+            confs_threshold,
+            images_input_folder_path,
+            images_output_folder_path,
+            batch_names,
+            batch_images,
+            save_txt,
+            save_conf,
+        )
 
 
 def predict_on_video(
@@ -144,6 +524,9 @@ def predict_on_video(
     input_video_path: str,
     output_video_path: str,
     max_frames: int = None,  # Optional: Set a frame limit for testing
+    batch_size: int = 16,
+    infer_stride: int = 2,
+    scene_change_threshold: float = None,
 ) -> None:
     """
     Processes a video using YOLO models to predict and annotate detections on frames.
@@ -153,15 +536,25 @@ def predict_on_video(
         model_paths (list[str]): Paths to YOLO model files.
         confs_threshold (list[float]): Confidence thresholds for each model.
         input_video_path (str): Path to input video.
-        output_video_path (str): Path to save annotated output video.
+        output_video_path (str): Path to save annotated output video. A '.m3u8' path is written
+            as an HLS playlist with its segments alongside.
         max_frames (int, optional): Max frames to process (for debugging). Default is None.
+        batch_size (int, optional): Number of frames passed to each model per call. Default is 16.
+        infer_stride (int, optional): Run the models on every k-th frame and reuse the last
+            detections for the frames in between. Default is 2.
+        scene_change_threshold (float, optional): If set, frames in between are also inferred when
+            their mean absolute difference to the last inferred frame (greyscale, downsampled)
+            exceeds this value. Default is None.
 
     Returns:
         None
+
+    Raises:
+        RuntimeError: If no frame can be read, or ffmpeg cannot be started or fails to encode the output.
     """
 
     # Load models dynamically from provided paths
-    models = [YOLO(path) for path in model_paths]
+    models = [get_model(path) for path in model_paths]
 
     # Open input video
     cap = cv2.VideoCapture(input_video_path)
@@ -185,47 +578,108 @@ def predict_on_video(
     print(f"📹 Processing video: {input_video_path}")
     print(f"Resolution: {frame_width}x{frame_height}, FPS: {frame_rate}, Total Frames: {total_frames}")
 
-    # Define output video writer
-    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-    out = cv2.VideoWriter(output_video_path, fourcc, frame_rate, (frame_width, frame_height))
+    # The raw stream given to ffmpeg must match the decoded frames exactly, and the
+    # decoder may disagree with the container (e.g. decord ignores rotation metadata)
+    frames = read_video_frames(cap, input_video_path, batch_size)
+    first_frame = next(frames, None)
+    if first_frame is None:
+        cap.release()
+        raise RuntimeError(f"Cannot read any frame from: {input_video_path}")
+    if first_frame.shape[:2] != (frame_height, frame_width):
+        frame_height, frame_width = first_frame.shape[:2]
+        print(f"⚠️ Warning: Decoded frames are {frame_width}x{frame_height}; encoding at that size.")
+
+    # Pipe raw frames to a single ffmpeg process encoding H.264 (and packaging HLS)
+    ffmpeg_command = [
+        "ffmpeg",
+        "-y",
+        "-f", "rawvideo",
+        "-pix_fmt", "bgr24",
+        "-s", f"{frame_width}x{frame_height}",
+        "-r", str(frame_rate),
+        "-i", "-",
+        "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+        "-codec:V", "libx264",
+        "-preset", "ultrafast",
+        "-pix_fmt", "yuv420p",
+    ]
+    if output_video_path.endswith(".m3u8"):
+        ffmpeg_command += [
+            "-flags", "+cgop",
+            "-g", "30",
+            "-hls_time", "4",
+            "-hls_list_size", "0",
+            "-f", "hls",
+        ]
+    ffmpeg_command.append(output_video_path)
+
+    try:
+        proc = subprocess.Popen(ffmpeg_command, stdin=subprocess.PIPE, bufsize=10 * 1024 * 1024)
+    except OSError as e:
+        cap.release()
+        raise RuntimeError(f"Cannot start ffmpeg: {e}") from e
+    out = proc.stdin
 
     processed_frames = 0
-    pbar = tqdm(total=total_frames if max_frames is None else min(max_frames, total_frames))
+    pbar = tqdm(
+        total=total_frames if max_frames is None else min(max_frames, total_frames),
+        disable=not _SHOW_PROGRESS,
+    )
+    frames_buf, infer_flags = [], []
+    last_results = None
+    last_thumbnail = None
 
-    while cap.isOpened():
-        success, frame = cap.read()
-        if not success:
-            print("✅ End of video or failed to read frame.")
-            break
+    pipe_broken = False
 
-        combined_results = []
-        try:
-            for i, model in enumerate(models):
-                results = model(frame, conf=confs_threshold[i])
-                
-                combined_results.extend(results)
-        except Exception as e:
-            print(f"⚠️ Error during model prediction: {e}")
-            continue
+    try:
+        for frame in itertools.chain([first_frame], frames):
+            if frame.shape[:2] != (frame_height, frame_width):
+                print(f"⚠️ Warning: Skipping frame with unexpected size {frame.shape[1]}x{frame.shape[0]}.")
+                continue
+
+            needs_inference = processed_frames % infer_stride == 0
+            if scene_change_threshold is not None:
+                thumbnail = cv2.cvtColor(cv2.resize(frame, (64, 64)), cv2.COLOR_BGR2GRAY)
+                if not needs_inference:
+                    needs_inference = cv2.absdiff(thumbnail, last_thumbnail).mean() > scene_change_threshold
+                if needs_inference:
+                    last_thumbnail = thumbnail
+
+            frames_buf.append(frame)
+            infer_flags.append(needs_inference)
+            processed_frames += 1
+
+            if len(frames_buf) == batch_size:
+                last_results = write_annotated_batch(
+                    models, confs_threshold, frames_buf, out, infer_flags, last_results
+                )
+                pbar.update(len(frames_buf))
+                frames_buf, infer_flags = [], []
+
+            if max_frames and processed_frames >= max_frames:
+                print(f"🛑 Frame limit ({max_frames}) reached. Exiting.")
+                break
 
-        # Combine detections and write annotated frame
+        # Flush the remaining partial batch
+        if frames_buf:
+            write_annotated_batch(models, confs_threshold, frames_buf, out, infer_flags, last_results)
+            pbar.update(len(frames_buf))
+    except BrokenPipeError:
+        print("❌ Error: ffmpeg stopped accepting frames.")
+        pipe_broken = True
+    finally:
+        # Closing stdin lets ffmpeg finish even if the frame loop failed
+        cap.release()
         try:
-            annotated_frame = combine_results(frame, combined_results)
-            out.write(annotated_frame)
-        except Exception as e:
-            print(f"⚠️ Error during frame annotation: {e}")
-            continue
+            out.close()
+        except BrokenPipeError:
+            pass
+        return_code = proc.wait()
+        pbar.close()
 
-        processed_frames += 1
-        pbar.update(1)
-
-        if max_frames and processed_frames >= max_frames:
-            print(f"🛑 Frame limit ({max_frames}) reached. Exiting.")
-            break
+    if return_code != 0 or pipe_broken:
+        raise RuntimeError(f"ffmpeg exited with code {return_code}")
 
-    cap.release()
-    out.release()
-    pbar.close()
     # Uncomment if you want to display the video in a windows/ GUI enabled machine
     # cv2.destroyAllWindows()
     print(f"✅ Output video saved to: {output_video_path}")